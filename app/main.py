@@ -3,18 +3,27 @@ from __future__ import annotations
 import os
 import time
 import re
-from collections import Counter
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import lru_cache
 import xml.etree.ElementTree as ET
 from pathlib import Path
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Iterable, Iterator, NamedTuple, Set
 
-from fastapi import FastAPI, HTTPException, Query
+import orjson
+from cachetools import TTLCache
+from fastapi import Depends, FastAPI, HTTPException, Query
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import Elasticsearch
 
 ES_HOST = os.getenv("ES_HOST", "http://localhost:9200")
-INDEX_NAME = os.getenv("ES_INDEX", "catalog_prefix")
+INDEX_MAPPING_VERSION = 2
+INDEX_NAME = f'{os.getenv("ES_INDEX", "catalog_prefix")}_v{INDEX_MAPPING_VERSION}'
 CATALOG_PATH = Path("data/catalog_products.xml")
+BULK_CHUNK_SIZE = 1000
+BULK_THREAD_COUNT = 8
+BULK_REQUEST_TIMEOUT = 60
 
 app = FastAPI(title="Prefix Search Assignment API")
 
@@ -40,8 +49,17 @@ class SearchResponse(BaseModel):
     numeric_filter: Optional[NumericFilter] = None
     results: List[Product]
 
+_ES = Elasticsearch(ES_HOST, http_compress=True, timeout=5, maxsize=32)
+
+_SEARCH_CACHE: TTLCache = TTLCache(maxsize=2048, ttl=60)
+_SEARCH_CACHE_LOCK = threading.Lock()
+_CATALOG_VERSION = 0
+
 def get_es() -> Elasticsearch:
-    return Elasticsearch(ES_HOST)
+    return _ES
+
+async def es_dependency() -> Elasticsearch:
+    return _ES
 
 INDEX_SETTINGS: Dict[str, Any] = {
     "settings": {
@@ -49,26 +67,12 @@ INDEX_SETTINGS: Dict[str, Any] = {
             "filter": {
                 "ru_stop": {"type": "stop", "stopwords": "_russian_"},
                 "ru_stemmer": {"type": "stemmer", "language": "russian"},
-                "edge_ngram_filter": {
-                    "type": "edge_ngram",
-                    "min_gram": 1,
-                    "max_gram": 15,
-                },
             },
             "analyzer": {
                 "ru_en_search": {
                     "tokenizer": "standard",
                     "filter": ["lowercase", "ru_stop", "ru_stemmer"],
                 },
-                "ru_en_edge_ngram": {
-                    "tokenizer": "standard",
-                    "filter": [
-                        "lowercase",
-                        "ru_stop",
-                        "ru_stemmer",
-                        "edge_ngram_filter",
-                    ],
-                },
             },
         }
     },
@@ -76,40 +80,27 @@ INDEX_SETTINGS: Dict[str, Any] = {
         "properties": {
             "id": {"type": "keyword"},
             "name": {
-                "type": "text",
+                "type": "search_as_you_type",
                 "analyzer": "ru_en_search",
                 "search_analyzer": "ru_en_search",
-                "fields": {
-                    "prefix": {
-                        "type": "text",
-                        "analyzer": "ru_en_edge_ngram",
-                        "search_analyzer": "ru_en_search",
-                    }
-                },
+                "store": True,
             },
             "category": {"type": "keyword"},
             "brand": {"type": "keyword"},
             "keywords": {
-                "type": "text",
+                "type": "search_as_you_type",
                 "analyzer": "ru_en_search",
                 "search_analyzer": "ru_en_search",
-                "fields": {
-                    "prefix": {
-                        "type": "text",
-                        "analyzer": "ru_en_edge_ngram",
-                        "search_analyzer": "ru_en_search",
-                    }
-                },
             },
             "description": {
                 "type": "text",
                 "analyzer": "ru_en_search",
                 "search_analyzer": "ru_en_search",
             },
-            "weight_value": {"type": "float"},
+            "weight_value": {"type": "double"},
             "weight_unit": {"type": "keyword"},
             "package_size": {"type": "integer"},
-            "price": {"type": "float"},
+            "price": {"type": "double"},
             "image_url": {"type": "keyword"},
         }
     },
@@ -132,15 +123,14 @@ def ensure_index() -> None:
     if count == 0:
         bulk_load_catalog(es)
 
-def bulk_load_catalog(es: Elasticsearch) -> None:
-    if not CATALOG_PATH.exists():
-        raise RuntimeError(f"Catalog file not found: {CATALOG_PATH}")
+def iter_catalog_docs() -> Iterator[Dict[str, Any]]:
+    context = ET.iterparse(str(CATALOG_PATH), events=("start", "end"))
+    _, root = next(context)
 
-    tree = ET.parse(str(CATALOG_PATH))
-    root = tree.getroot()
-    actions = []
+    for event, product in context:
+        if event != "end" or product.tag != "product":
+            continue
 
-    for product in root.findall("product"):
         pid = product.get("id")
         name = product.findtext("name", default="")
         category = product.findtext("category", default="")
@@ -163,7 +153,7 @@ def bulk_load_catalog(es: Elasticsearch) -> None:
 
         image_url = product.findtext("image_url", default="")
 
-        doc = {
+        yield {
             "id": pid,
             "name": name,
             "category": category,
@@ -177,17 +167,69 @@ def bulk_load_catalog(es: Elasticsearch) -> None:
             "image_url": image_url,
         }
 
-        actions.append(
-            {
-                "_index": INDEX_NAME,
-                "_id": pid,
-                "_source": doc,
-            }
+        product.clear()
+        root.clear()
+
+def iter_bulk_payloads(docs: Iterable[Dict[str, Any]], chunk_size: int) -> Iterator[bytes]:
+    lines: List[bytes] = []
+    for doc in docs:
+        lines.append(orjson.dumps({"index": {"_id": doc["id"]}}))
+        lines.append(orjson.dumps(doc))
+        if len(lines) >= chunk_size * 2:
+            yield b"\n".join(lines) + b"\n"
+            lines = []
+    if lines:
+        yield b"\n".join(lines) + b"\n"
+
+def bulk_load_catalog(es: Elasticsearch) -> None:
+    if not CATALOG_PATH.exists():
+        raise RuntimeError(f"Catalog file not found: {CATALOG_PATH}")
+
+    es.indices.put_settings(
+        index=INDEX_NAME, body={"index": {"refresh_interval": "-1"}}
+    )
+    failed: List[Dict[str, Any]] = []
+
+    def collect(futures: Iterable[Future]) -> None:
+        for fut in futures:
+            resp = fut.result()
+            if resp.get("errors"):
+                failed.extend(
+                    item
+                    for item in resp.get("items", [])
+                    if "error" in item.get("index", {})
+                )
+
+    try:
+        with ThreadPoolExecutor(max_workers=BULK_THREAD_COUNT) as pool:
+            in_flight: Set[Future] = set()
+            for payload in iter_bulk_payloads(iter_catalog_docs(), BULK_CHUNK_SIZE):
+                if len(in_flight) >= BULK_THREAD_COUNT:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight.add(
+                    pool.submit(
+                        es.bulk,
+                        index=INDEX_NAME,
+                        body=payload,
+                        request_timeout=BULK_REQUEST_TIMEOUT,
+                    )
+                )
+            collect(wait(in_flight).done)
+    finally:
+        es.indices.put_settings(
+            index=INDEX_NAME, body={"index": {"refresh_interval": "1s"}}
         )
 
-    if actions:
-        helpers.bulk(es, actions)
-        es.indices.refresh(index=INDEX_NAME)
+    if failed:
+        raise RuntimeError(f"Failed to index {len(failed)} products: {failed[:3]}")
+
+    es.indices.refresh(index=INDEX_NAME)
+
+    global _CATALOG_VERSION
+    with _SEARCH_CACHE_LOCK:
+        _CATALOG_VERSION += 1
+        _SEARCH_CACHE.clear()
 
 RU_TO_EN = dict(
     zip(
@@ -197,32 +239,47 @@ RU_TO_EN = dict(
 )
 EN_TO_RU = {v: k for k, v in RU_TO_EN.items()}
 
-def convert_layout(text: str, mapping: Dict[str, str]) -> str:
-    return "".join(mapping.get(ch, mapping.get(ch.lower(), ch)) for ch in text)
+def build_layout_table(mapping: Dict[str, str]) -> Dict[int, str]:
+    return str.maketrans({**mapping, **{k.upper(): v for k, v in mapping.items()}})
+
+_EN2RU_TABLE = build_layout_table(EN_TO_RU)
+_RU2EN_TABLE = build_layout_table(RU_TO_EN)
+
+def convert_layout(text: str, table: Dict[int, str]) -> str:
+    return text.translate(table)
+
+_HAS_CYR = re.compile(r"[а-я]").search
+_HAS_LAT = re.compile(r"[a-z]").search
 
-def normalize_query(raw: str) -> Dict[str, Optional[str]]:
+class NormalizedQuery(NamedTuple):
+    original: str
+    normalized: str
+    layout_fixed: Optional[str]
+
+@lru_cache(maxsize=4096)
+def normalize_query(raw: str) -> NormalizedQuery:
     q = (raw or "").strip()
     if not q:
-        return {"original": raw, "normalized": "", "layout_fixed": None}
+        return NormalizedQuery(original=raw, normalized="", layout_fixed=None)
 
     q_norm = q.lower()
-    to_ru = convert_layout(q_norm, EN_TO_RU)
-    to_en = convert_layout(q_norm, RU_TO_EN)
+    to_ru = convert_layout(q_norm, _EN2RU_TABLE)
+    to_en = convert_layout(q_norm, _RU2EN_TABLE)
 
     layout_fixed = None
-    if to_ru != q_norm and any("а" <= ch <= "я" for ch in to_ru):
+    if to_ru != q_norm and _HAS_CYR(to_ru):
         layout_fixed = to_ru
-    elif to_en != q_norm and any("a" <= ch <= "z" for ch in to_en):
+    elif to_en != q_norm and _HAS_LAT(to_en):
         layout_fixed = to_en
 
-    return {"original": raw, "normalized": q_norm, "layout_fixed": layout_fixed}
+    return NormalizedQuery(original=raw, normalized=q_norm, layout_fixed=layout_fixed)
 
 NUMERIC_RE = re.compile(
     r"(\d+(?:[.,]\d+)?)\s*(кг|kg|г|гр|g|л|l|мл|ml)",
     re.IGNORECASE,
 )
 
-UNIT_ALIASES = {
+_BASE_UNIT_ALIASES = {
     "кг": "kg",
     "kg": "kg",
     "г": "g",
@@ -234,7 +291,18 @@ UNIT_ALIASES = {
     "ml": "ml",
 }
 
-def extract_numeric_filter(text: str) -> Optional[Dict[str, Any]]:
+UNIT_ALIASES = {
+    alias: unit
+    for base, unit in _BASE_UNIT_ALIASES.items()
+    for alias in (base, base.upper(), base.title())
+}
+
+class ParsedNumeric(NamedTuple):
+    value: float
+    unit: str
+
+@lru_cache(maxsize=4096)
+def extract_numeric_filter(text: str) -> Optional[ParsedNumeric]:
     m = NUMERIC_RE.search(text)
     if not m:
         return None
@@ -245,72 +313,47 @@ def extract_numeric_filter(text: str) -> Optional[Dict[str, Any]]:
     except ValueError:
         return None
 
-    unit = UNIT_ALIASES.get(raw_unit.lower())
+    unit = UNIT_ALIASES.get(raw_unit) or UNIT_ALIASES.get(raw_unit.lower())
     if not unit:
         return None
 
-    return {"value": value, "unit": unit}
-
-@app.on_event("startup")
-def on_startup() -> None:
-    ensure_index()
-
-@app.get("/health")
-def health() -> Dict[str, str]:
-    return {"status": "ok"}
-
-@app.get("/search", response_model=SearchResponse)
-def search(
-    q: str = Query(..., min_length=1, description="Raw user query"),
-    top_k: int = Query(5, ge=1, le=50),
-):
-    es = get_es()
-    norm = normalize_query(q)
-
-    numeric = extract_numeric_filter(norm["normalized"])
-    numeric_filter_debug: Optional[Dict[str, Any]] = None
-
-    should_queries: List[Dict[str, Any]] = []
-
-    should_queries.append(
-        {
-            "multi_match": {
-                "query": norm["normalized"],
-                "type": "bool_prefix",
-                "fields": [
-                    "name.prefix^4",
-                    "name^3",
-                    "brand^3",
-                    "category^2",
-                    "keywords.prefix^2",
-                    "description",
-                ],
-            }
-        }
-    )
-
-    if norm["layout_fixed"] and norm["layout_fixed"] != norm["normalized"]:
+    return ParsedNumeric(value=value, unit=unit)
+
+_MM_FIELDS = [
+    "name._index_prefix^4",
+    "name^3",
+    "name._2gram^3",
+    "name._3gram^3",
+    "brand^3",
+    "category^2",
+    "keywords._index_prefix^2",
+    "description",
+]
+_MM_TEMPLATE = {"type": "bool_prefix", "fields": _MM_FIELDS}
+
+def layout_fix_applies(original: str, fixed: str) -> bool:
+    prev = " "
+    for a, b in zip(original, fixed):
+        if a != b and (a.isalpha() or prev.isspace()):
+            return True
+        prev = a
+    return False
+
+def build_search_body(
+    norm: NormalizedQuery, numeric: Optional[ParsedNumeric], top_k: int
+) -> Dict[str, Any]:
+    should_queries: List[Dict[str, Any]] = [
+        {"multi_match": {**_MM_TEMPLATE, "query": norm.normalized}}
+    ]
+
+    if norm.layout_fixed and layout_fix_applies(norm.normalized, norm.layout_fixed):
         should_queries.append(
-            {
-                "multi_match": {
-                    "query": norm["layout_fixed"],
-                    "type": "bool_prefix",
-                    "fields": [
-                        "name.prefix^4",
-                        "name^3",
-                        "brand^3",
-                        "category^2",
-                        "keywords.prefix^2",
-                        "description",
-                    ],
-                }
-            }
+            {"multi_match": {**_MM_TEMPLATE, "query": norm.layout_fixed}}
         )
 
     if numeric:
-        numeric_filter_debug = numeric
-        value = numeric["value"]
-        unit = numeric["unit"]
+        value = numeric.value
+        unit = numeric.unit
 
         should_queries.append(
             {
@@ -338,7 +381,7 @@ def search(
     if not should_queries:
         raise HTTPException(status_code=400, detail="Empty query")
 
-    body = {
+    return {
         "size": top_k * 5,
         "query": {
             "bool": {
@@ -346,9 +389,10 @@ def search(
                 "minimum_should_match": 1,
             }
         },
-        "_source": [
+        "_source": False,
+        "stored_fields": ["name"],
+        "docvalue_fields": [
             "id",
-            "name",
             "category",
             "brand",
             "price",
@@ -358,63 +402,107 @@ def search(
         ],
     }
 
+def cached_search(
+    es: Elasticsearch,
+    norm: NormalizedQuery,
+    numeric: Optional[ParsedNumeric],
+    top_k: int,
+) -> List[Dict[str, Any]]:
+    key = (norm.normalized, norm.layout_fixed, numeric, top_k, _CATALOG_VERSION)
+    with _SEARCH_CACHE_LOCK:
+        hits = _SEARCH_CACHE.get(key)
+    if hits is not None:
+        return hits
+
+    body = build_search_body(norm, numeric, top_k)
+
     try:
-        resp = es.search(index=INDEX_NAME, body=body)
+        resp = es.search(
+            index=INDEX_NAME,
+            body=body,
+            filter_path=["hits.hits._score", "hits.hits.fields"],
+        )
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Search error: {exc}")
 
-    hits = resp.get("hits", {}).get("hits", [])
+    hits = [
+        {
+            "_score": h.get("_score"),
+            "_source": {k: v[0] for k, v in h.get("fields", {}).items()},
+        }
+        for h in resp.get("hits", {}).get("hits", [])
+    ]
+    with _SEARCH_CACHE_LOCK:
+        _SEARCH_CACHE[key] = hits
+    return hits
 
-    if hits:
-        top_score = hits[0].get("_score") or 0.0
+@app.on_event("startup")
+def on_startup() -> None:
+    ensure_index()
+
+@app.get("/health")
+def health() -> Dict[str, str]:
+    return {"status": "ok"}
+
+@app.get(
+    "/search",
+    response_class=ORJSONResponse,
+    responses={200: {"model": SearchResponse}},
+)
+def search(
+    q: str = Query(..., min_length=1, description="Raw user query"),
+    top_k: int = Query(5, ge=1, le=50),
+    es: Elasticsearch = Depends(es_dependency),
+) -> ORJSONResponse:
+    norm = normalize_query(q)
 
+    numeric = extract_numeric_filter(norm.normalized)
+
+    hits = cached_search(es, norm, numeric, top_k)
+
+    if hits:
+        top_score = hits[0]["_score"] or 0.0
         score_threshold = top_score * 0.3
-        filtered_hits = [
-            h for h in hits
-            if (h.get("_score") or 0.0) >= score_threshold
-        ]
-
-        categories = [
-            h.get("_source", {}).get("category")
-            for h in filtered_hits
-            if h.get("_source", {}).get("category")
-        ]
-
-        if categories:
-            dominant_category, _ = Counter(categories).most_common(1)[0]
-            filtered_hits2: List[Dict[str, Any]] = []
-            for h in filtered_hits:
-                cat = h.get("_source", {}).get("category")
-                sc = h.get("_score") or 0.0
-                if cat == dominant_category or sc >= top_score * 0.8:
-                    filtered_hits2.append(h)
-            hits = filtered_hits2
-        else:
-            hits = filtered_hits
-
-        hits = hits[:top_k]
-
-    results: List[Product] = []
+        high_score = top_score * 0.8
+
+        scored = [(h, h["_score"] or 0.0, h["_source"].get("category")) for h in hits]
+
+        counts: Dict[str, int] = {}
+        for _, sc, cat in scored:
+            if sc >= score_threshold and cat:
+                counts[cat] = counts.get(cat, 0) + 1
+        dominant_category = max(counts, key=counts.get) if counts else None
+
+        hits = [
+            h
+            for h, sc, cat in scored
+            if sc >= score_threshold
+            and (dominant_category is None or cat == dominant_category or sc >= high_score)
+        ][:top_k]
+
+    results: List[Dict[str, Any]] = []
     for h in hits:
         src = h.get("_source", {})
         results.append(
-            Product(
-                id=src.get("id", ""),
-                name=src.get("name", ""),
-                category=src.get("category", ""),
-                brand=src.get("brand", ""),
-                price=float(src.get("price", 0.0)),
-                weight_value=src.get("weight_value"),
-                weight_unit=src.get("weight_unit"),
-                image_url=src.get("image_url"),
-                score=h.get("_score"),
-            )
+            {
+                "id": src.get("id", ""),
+                "name": src.get("name", ""),
+                "category": src.get("category", ""),
+                "brand": src.get("brand", ""),
+                "price": float(src.get("price", 0.0)),
+                "weight_value": src.get("weight_value"),
+                "weight_unit": src.get("weight_unit"),
+                "image_url": src.get("image_url"),
+                "score": h.get("_score"),
+            }
         )
 
-    return SearchResponse(
-        query=norm["original"],
-        normalized_query=norm["normalized"],
-        layout_fixed_query=norm["layout_fixed"],
-        numeric_filter=NumericFilter(**numeric_filter_debug) if numeric_filter_debug else None,
-        results=results,
+    return ORJSONResponse(
+        {
+            "query": norm.original,
+            "normalized_query": norm.normalized,
+            "layout_fixed_query": norm.layout_fixed,
+            "numeric_filter": numeric._asdict() if numeric else None,
+            "results": results,
+        }
     )
\ No newline at end of file
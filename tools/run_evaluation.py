@@ -2,14 +2,36 @@ from __future__ import annotations
 
 import argparse
 import csv
+import http.client
 import json
-import math
 import os
 import statistics
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, List, Optional
-from urllib import parse, request, error
+from typing import Any, Dict, List, Optional, Tuple
+from urllib import parse, error
+
+
+TOP_N_COLUMNS = 3
+TOP_N_FIELDS = ["id", "name", "category", "brand", "score"]
+RESULT_COLUMNS = [
+    "query",
+    "store",
+    "expected_category",
+    "normalized_query",
+    "layout_fixed_query",
+    "numeric_value",
+    "numeric_unit",
+    "latency_ms",
+    "num_results",
+    "hit_in_top3_by_category",
+] + [
+    f"top{rank+1}_{field}"
+    for rank in range(TOP_N_COLUMNS)
+    for field in TOP_N_FIELDS
+]
 
 
 def parse_args() -> argparse.Namespace:
@@ -37,21 +59,20 @@ def parse_args() -> argparse.Namespace:
         default=5,
         help="How many results to request from API (default: 5)",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="How many queries to run concurrently (default: 1). Latencies "
+        "measured with more than one worker are not comparable to sequential runs",
+    )
     return parser.parse_args()
 
 
-def percentile(values: List[float], p: float) -> float:
-    if not values:
-        return 0.0
-    data = sorted(values)
-    k = (len(data) - 1) * (p / 100.0)
-    f = math.floor(k)
-    c = math.ceil(k)
-    if f == c:
-        return float(data[int(k)])
-    d0 = data[f] * (c - k)
-    d1 = data[c] * (k - f)
-    return float(d0 + d1)
+def latency_percentiles(values: List[float]) -> List[float]:
+    if len(values) < 2:
+        return [float(values[0]) if values else 0.0] * 99
+    return statistics.quantiles(values, n=100, method="inclusive")
 
 
 def pick_first_existing(fieldnames: List[str], candidates: List[str]) -> Optional[str]:
@@ -61,16 +82,119 @@ def pick_first_existing(fieldnames: List[str], candidates: List[str]) -> Optiona
     return None
 
 
+_local = threading.local()
+
+
+def get_connection(base: parse.SplitResult) -> http.client.HTTPConnection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn_cls = (
+            http.client.HTTPSConnection
+            if base.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        conn = conn_cls(base.netloc, timeout=10)
+        _local.conn = conn
+    return conn
+
+
+def drop_connection() -> None:
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+    _local.conn = None
+
+
+def send_get(base: parse.SplitResult, path: str) -> Tuple[http.client.HTTPResponse, bytes]:
+    conn = get_connection(base)
+    try:
+        conn.request("GET", path)
+        resp = conn.getresponse()
+        return resp, resp.read()
+    except Exception:
+        drop_connection()
+        raise
+
+
 def call_search(base_url: str, query: str, top_k: int) -> Dict[str, Any]:
     params = {"q": query, "top_k": str(top_k)}
     url = base_url.rstrip("/") + "/search?" + parse.urlencode(params)
-    req = request.Request(url, method="GET")
-
-    opener = request.build_opener(request.ProxyHandler({}))
+    base = parse.urlsplit(url)
+    path = base.path + "?" + base.query
+
+    try:
+        resp, payload = send_get(base, path)
+    except ConnectionError:
+        # the server closed the keep-alive connection, retry on a fresh one
+        resp, payload = send_get(base, path)
+
+    if resp.status >= 400:
+        raise error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+    return json.loads(payload.decode("utf-8"))
+
+
+def run_one(
+    row: Dict[str, str],
+    base_url: str,
+    top_k: int,
+    query_col: str,
+    store_col: Optional[str],
+    expected_cat_col: Optional[str],
+) -> Optional[Tuple[str, Dict[str, Any], float, str]]:
+    raw_query = (row.get(query_col) or "").strip()
+    if not raw_query:
+        return None
+
+    t0 = time.perf_counter()
+    try:
+        resp_json = call_search(base_url, raw_query, top_k)
+        latency_ms = (time.perf_counter() - t0) * 1000.0
+    except error.HTTPError as e:
+        return raw_query, {}, 0.0, f"HTTP {e.code}"
+    except Exception as e:
+        return raw_query, {}, 0.0, f"ERROR: {e}"
+
+    results = resp_json.get("results", []) or []
+    num_results = len(results)
+
+    normalized_query = resp_json.get("normalized_query") or ""
+    layout_fixed_query = resp_json.get("layout_fixed_query") or ""
+    numeric_filter = resp_json.get("numeric_filter") or None
+
+    expected_category = (
+        (row.get(expected_cat_col) or "").strip().lower()
+        if expected_cat_col
+        else ""
+    )
 
-    with opener.open(req, timeout=10) as resp:
-        payload = resp.read().decode("utf-8")
-        return json.loads(payload)
+    hit_in_top3 = ""
+    if expected_category:
+        hit = any(
+            (res.get("category") or "").strip().lower() == expected_category
+            for res in results[:3]
+        )
+        hit_in_top3 = "1" if hit else "0"
+
+    flat: Dict[str, Any] = dict.fromkeys(RESULT_COLUMNS, "")
+    flat["query"] = raw_query
+    if store_col:
+        flat["store"] = row.get(store_col, "")
+    flat["expected_category"] = expected_category
+    flat["normalized_query"] = normalized_query
+    flat["layout_fixed_query"] = layout_fixed_query
+    if isinstance(numeric_filter, dict):
+        flat["numeric_value"] = numeric_filter.get("value")
+        flat["numeric_unit"] = numeric_filter.get("unit")
+    flat["latency_ms"] = round(latency_ms, 1)
+    flat["num_results"] = num_results
+    flat["hit_in_top3_by_category"] = hit_in_top3
+
+    for rank, res in enumerate(results[:TOP_N_COLUMNS]):
+        prefix = f"top{rank+1}_"
+        for field in TOP_N_FIELDS:
+            flat[prefix + field] = res.get(field, "")
+
+    return raw_query, flat, latency_ms, ""
 
 
 def main() -> None:
@@ -117,93 +241,38 @@ def main() -> None:
     labeled = 0
     labeled_with_hit_top3 = 0
 
-    for idx, row in enumerate(rows, start=1):
-        raw_query = (row.get(query_col) or "").strip()
-        if not raw_query:
-            continue
+    def run(row: Dict[str, str]) -> Optional[Tuple[str, Dict[str, Any], float, str]]:
+        return run_one(
+            row, args.base_url, args.top_k, query_col, store_col, expected_cat_col
+        )
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for idx, outcome in enumerate(executor.map(run, rows), start=1):
+            if outcome is None:
+                continue
 
-        print(f"[{idx}/{total}] q={raw_query!r}", end="", flush=True)
+            raw_query, flat, latency_ms, err = outcome
+            print(f"[{idx}/{total}] q={raw_query!r}", end="", flush=True)
+            if err:
+                print(f" -> {err}")
+                continue
 
-        t0 = time.perf_counter()
-        try:
-            resp_json = call_search(args.base_url, raw_query, args.top_k)
-            latency_ms = (time.perf_counter() - t0) * 1000.0
             latencies_ms.append(latency_ms)
-        except error.HTTPError as e:
-            print(f" -> HTTP {e.code}")
-            continue
-        except Exception as e:
-            print(f" -> ERROR: {e}")
-            continue
-
-        results = resp_json.get("results", []) or []
-        num_results = len(results)
-        if num_results > 0:
-            with_results += 1
-
-        normalized_query = resp_json.get("normalized_query") or ""
-        layout_fixed_query = resp_json.get("layout_fixed_query") or ""
-        numeric_filter = resp_json.get("numeric_filter") or None
-
-        expected_category = (
-            (row.get(expected_cat_col) or "").strip().lower()
-            if expected_cat_col
-            else ""
-        )
+            if flat["num_results"] > 0:
+                with_results += 1
+            if flat["hit_in_top3_by_category"]:
+                labeled += 1
+                if flat["hit_in_top3_by_category"] == "1":
+                    labeled_with_hit_top3 += 1
 
-        hit_in_top3 = ""
-        if expected_category:
-            labeled += 1
-            hit = any(
-                (res.get("category") or "").strip().lower() == expected_category
-                for res in results[:3]
-            )
-            if hit:
-                labeled_with_hit_top3 += 1
-            hit_in_top3 = "1" if hit else "0"
-
-        flat: Dict[str, Any] = {
-            "query": raw_query,
-            "store": row.get(store_col, "") if store_col else "",
-            "expected_category": expected_category,
-            "normalized_query": normalized_query,
-            "layout_fixed_query": layout_fixed_query,
-            "numeric_value": numeric_filter.get("value")
-            if isinstance(numeric_filter, dict)
-            else "",
-            "numeric_unit": numeric_filter.get("unit")
-            if isinstance(numeric_filter, dict)
-            else "",
-            "latency_ms": round(latency_ms, 1),
-            "num_results": num_results,
-            "hit_in_top3_by_category": hit_in_top3,
-        }
-
-        for rank in range(3):
-            prefix = f"top{rank+1}_"
-            if rank < num_results:
-                res = results[rank]
-                flat[prefix + "id"] = res.get("id", "")
-                flat[prefix + "name"] = res.get("name", "")
-                flat[prefix + "category"] = res.get("category", "")
-                flat[prefix + "brand"] = res.get("brand", "")
-                flat[prefix + "score"] = res.get("score", "")
-            else:
-                flat[prefix + "id"] = ""
-                flat[prefix + "name"] = ""
-                flat[prefix + "category"] = ""
-                flat[prefix + "brand"] = ""
-                flat[prefix + "score"] = ""
-
-        result_rows.append(flat)
-        print(f" -> {num_results} hits, {latency_ms:.1f} ms")
+            result_rows.append(flat)
+            print(f" -> {flat['num_results']} hits, {latency_ms:.1f} ms")
 
     if not result_rows:
         raise SystemExit("No successful responses collected")
 
-    out_fieldnames = list(result_rows[0].keys())
     with out_path.open("w", encoding="utf-8", newline="") as f_out:
-        writer = csv.DictWriter(f_out, fieldnames=out_fieldnames)
+        writer = csv.DictWriter(f_out, fieldnames=RESULT_COLUMNS)
         writer.writeheader()
         writer.writerows(result_rows)
 
@@ -225,9 +294,13 @@ def main() -> None:
         print("No expected_category/target_category column – P@3 not computed.")
 
     if latencies_ms:
+        pct = latency_percentiles(latencies_ms)
+        if args.workers > 1:
+            print(f"Latencies measured under {args.workers} concurrent requests")
         print(f"Avg latency: {statistics.mean(latencies_ms):.1f} ms")
-        print(f"Median latency: {statistics.median(latencies_ms):.1f} ms")
-        print(f"95p latency: {percentile(latencies_ms, 95):.1f} ms")
+        print(f"Median latency: {pct[49]:.1f} ms")
+        print(f"95p latency: {pct[94]:.1f} ms")
+        print(f"99p latency: {pct[98]:.1f} ms")
 
     print(f"\nDetailed results written to: {out_path}")
 